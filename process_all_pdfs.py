@@ -1,9 +1,21 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import os
+import io
+import re
 import glob
-import xml.etree.ElementTree as ET
+from lxml import etree
 import time
+import queue
+import sqlite3
+import hashlib
+import threading
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+import docx
 from docx import Document # 追加: Word作成用
 from docx.shared import Pt # 追加: フォントサイズ指定用
 
@@ -17,117 +29,422 @@ GROBID_URL = os.getenv("GROBID_API_URL", "http://localhost:8070/api/processFullt
 
 TARGET_LANG = "JA"
 GROBID_TIMEOUT = 180
+GROBID_CONCURRENCY = int(os.getenv("GROBID_CONCURRENCY", "10")) # GROBIDへの同時リクエスト数
+GROBID_MAX_RETRIES = 5 # GROBID混雑時(503/408)の最大リトライ回数
+TRANSLATE_CONCURRENCY = int(os.getenv("TRANSLATE_CONCURRENCY", "2")) # 同時に翻訳するPDF数
+PIPELINE_QUEUE_SIZE = 32 # GROBID解析済みで翻訳待ちのXMLを保持する上限
+DEEPL_BATCH_SIZE = 50 # 1リクエストあたりの最大段落数 (DeepLの上限)
+DEEPL_BATCH_BYTES = 70 * 1024 # 1リクエストあたりの最大バイト数 (リクエストサイズ上限に余裕を持たせる)
+DEEPL_MAX_RETRIES = 5 # レート制限(429)時の最大リトライ回数
+DEEPL_CONCURRENCY = int(os.getenv("DEEPL_CONCURRENCY", "10")) # DeepLへの同時リクエスト数 (プロセス全体、全PDF合計)
 INPUT_DIR = "input_pdf"
 OUTPUT_DIR = "output_pdf"
 
 # 出力フォルダ設定
 OUTPUT_XML_DIR = os.path.join(OUTPUT_DIR, "xml")
 OUTPUT_DOCX_DIR = os.path.join(OUTPUT_DIR, "docx") # 変更: docx用フォルダ
+DOCX_SUFFIX = "_translated.docx"
+OUTPUT_PROGRESS_DIR = os.path.join(OUTPUT_DIR, "progress") # 翻訳途中の段落 (中断からの再開用)
+HTTP_POOL_SIZE = DEEPL_CONCURRENCY # 接続プールのサイズ (GROBIDは専用のプールを使う)
+CACHE_PATH = os.path.join(OUTPUT_DIR, "deepl_cache.db") # 翻訳キャッシュ (段落単位)
+CACHE_COMMIT_INTERVAL = 100 # この件数ごとにキャッシュをコミット
+QUOTA_EXCEEDED_TEXT = "[Translation Error: Quota Exceeded]"
+CJK_SKIP_RATIO = 0.5 # かなを含み、かな・漢字の割合がこれを超える段落は翻訳済み(日本語)とみなす
 NAMESPACES = {'tei': 'http://www.tei-c.org/ns/1.0'}
 
+# URL・DOI・数字や記号のみの段落 (翻訳しても結果が変わらないためDeepLに送らない)
+_NO_TRANSLATE_RE = re.compile(r'^\s*(https?://\S+|10\.\d{4,}/\S+|[\d\W_]+)\s*$')
+_KANA_RE = re.compile(r'[\u3040-\u30ff]')
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]')
+
+# 名前空間付きのタグ名は事前に組み立て、全PDFで使い回す
+TEI = "{%s}" % NAMESPACES["tei"]
+TAG_TEXT = TEI + "text"
+TAG_P = TEI + "p"
+TAG_TITLE = TEI + "title"
+TAG_TITLE_STMT = TEI + "titleStmt"
+TAG_LIST_BIBL = TEI + "listBibl"
+TAG_BIB = TEI + "biblStruct"
+TAG_DATE = TEI + "date"
+
+# XPathは事前にコンパイルし、全PDFで使い回す
+_XP_BIB_PUB = etree.XPath('.//tei:publicationStmt/tei:publisher', namespaces=NAMESPACES)
+
 # ------------------------------------------------
 
+def create_session():
+    """Keep-Aliveで接続を使い回すSessionを作成 (TCP/TLSハンドシェイクを省略)"""
+    session = requests.Session()
+    # 429は呼び出し側で全スレッド共通のRetry-After待機を行うため、ここでは対象外
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=None, # POSTもリトライ対象にする
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    # pool_block: 全スレッドがプール内の接続を使い回し、上限を超えて使い捨ての接続を作らない
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # GROBIDへのPDFはストリーミング送信しており送信済みの本文を巻き戻せないため、
+    # 接続確立時のエラーのみリトライする (503などはアプリ側でPDFを開き直して再送)
+    grobid_retry = Retry(total=3, read=0, status=0, backoff_factor=0.5)
+    grobid_adapter = HTTPAdapter(pool_connections=GROBID_CONCURRENCY, pool_maxsize=GROBID_CONCURRENCY, max_retries=grobid_retry, pool_block=True)
+    session.mount(GROBID_URL, grobid_adapter)
+    return session
+
+_SESSION = create_session()
+
 def setup_directories():
     os.makedirs(OUTPUT_XML_DIR, exist_ok=True)
     os.makedirs(OUTPUT_DOCX_DIR, exist_ok=True)
-
-def translate_text_via_deepl(text):
-    """DeepL APIを使ってテキストを翻訳"""
-    if not text or not text.strip():
-        return ""
-    
-    params = {
-        "auth_key": DEEPL_API_KEY,
-        "text": text,
-        "target_lang": TARGET_LANG
-    }
+    os.makedirs(OUTPUT_PROGRESS_DIR, exist_ok=True)
+
+def remove_orphan_tmp_files():
+    """前回の実行が中断した際に残った書きかけの一時ファイルを削除"""
+    for tmp_path in glob.glob(os.path.join(OUTPUT_DIR, "**", "*.tmp"), recursive=True):
+        os.remove(tmp_path)
+        print(f"🧹 書きかけの一時ファイルを削除: {tmp_path}")
+
+def write_text_atomic(path, text):
+    """一時ファイルに書き込んでからリネームし、書きかけのファイルを残さない"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+# --- ▼ 翻訳キャッシュ ▼ ---
+
+_cache = None
+_cache_lock = threading.Lock()
+_cache_pending = 0
+
+def open_cache():
+    """翻訳キャッシュ(SQLite)を開く。翻訳済みの段落はDeepLに再送しない"""
+    global _cache
+    _cache = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+    _cache.execute("PRAGMA journal_mode=WAL")
+    _cache.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+    _cache.commit()
+
+def close_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.commit()
+            _cache.close()
+            _cache = None
+
+def _cache_key(text):
+    return hashlib.sha256(f"{TARGET_LANG}\0{text}".encode("utf-8")).hexdigest()
+
+def cache_get(keys):
+    """キャッシュ済みの翻訳を {key: 翻訳文} で返す"""
+    if not keys:
+        return {}
+    with _cache_lock:
+        if _cache is None:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        rows = _cache.execute(f"SELECT key, text FROM translations WHERE key IN ({placeholders})", keys).fetchall()
+    return dict(rows)
+
+def cache_put(texts, translations):
+    """翻訳結果を段落単位でキャッシュに保存 (一定件数ごとにコミット)"""
+    global _cache_pending
+    with _cache_lock:
+        if _cache is None:
+            return
+        _cache.executemany(
+            "INSERT OR REPLACE INTO translations (key, text) VALUES (?, ?)",
+            [(_cache_key(t), tr) for t, tr in zip(texts, translations)]
+        )
+        _cache_pending += len(texts)
+        if _cache_pending >= CACHE_COMMIT_INTERVAL:
+            _cache.commit()
+            _cache_pending = 0
+
+# --- ▼ DeepL翻訳 ▼ ---
+
+def translate_text_via_deepl(texts):
+    """DeepL APIを使って複数テキストを1リクエストでまとめて翻訳 (キャッシュ済みの段落は送信しない)"""
+    if not texts:
+        return []
+
+    keys = [_cache_key(t) for t in texts]
+    cached = cache_get(keys)
+    results = [cached.get(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        translated = _request_deepl([texts[i] for i in missing])
+        for i, trans in zip(missing, translated):
+            results[i] = trans
+    return results
+
+# 同時に翻訳中のPDFが複数あっても、DeepLへの同時リクエスト数はプロセス全体でDEEPL_CONCURRENCYまで
+_deepl_slots = threading.BoundedSemaphore(DEEPL_CONCURRENCY)
+
+# 429を受けたら全スレッド共通で次の送信可能時刻を後ろにずらす (同じAPIキーを共有しているため)
+_deepl_rate_lock = threading.Lock()
+_deepl_next_allowed_ts = 0.0
+
+def _wait_for_deepl_window():
+    """他のスレッドが受けた429の待機時間が明けるまで待つ"""
+    while True:
+        with _deepl_rate_lock:
+            wait = _deepl_next_allowed_ts - time.monotonic()
+        if wait <= 0:
+            return
+        time.sleep(wait)
+
+def _defer_deepl_requests(wait):
+    global _deepl_next_allowed_ts
+    with _deepl_rate_lock:
+        _deepl_next_allowed_ts = max(_deepl_next_allowed_ts, time.monotonic() + wait)
+
+def _post_deepl(params):
+    """DeepLへPOSTする。429の場合のみRetry-Afterに従って待機し、再送する"""
+    for attempt in range(DEEPL_MAX_RETRIES):
+        with _deepl_slots:
+            # 枠の確保を待つ間に他スレッドが429を受けている場合があるため、確保後に待機時間を確認する
+            _wait_for_deepl_window()
+            response = _SESSION.post(DEEPL_URL, data=params, timeout=30)
+            if response.status_code != 429:
+                return response
+            if attempt == DEEPL_MAX_RETRIES - 1:
+                break # 最後の試行後は再送しないため、他スレッドを待たせない
+
+            # Retry-Afterヘッダーがあればその秒数だけ待機 (なければ指数バックオフ)
+            # 枠を手放す前に期限を設定し、次に枠を得たスレッドが待機時間内に送信しないようにする
+            retry_after = response.headers.get("Retry-After", "")
+            wait = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+            print(f"  ⏳ レート制限 (429): {wait}秒待機します...")
+            _defer_deepl_requests(wait)
+    return response
+
+def _request_deepl(texts):
+    """DeepL APIへ1リクエスト送信し、翻訳結果を返す (成功時のみキャッシュに保存)"""
+    # textキーを繰り返し指定すると、1リクエストで複数テキストを送信できる
+    params = [("auth_key", DEEPL_API_KEY), ("target_lang", TARGET_LANG)]
+    params += [("text", t) for t in texts]
 
     try:
-        response = requests.post(DEEPL_URL, data=params, timeout=30)
-        if response.status_code == 200:
-            return response.json()["translations"][0]["text"]
-        elif response.status_code == 456:
-            return "[Translation Error: Quota Exceeded]"
-        else:
-            print(f"  ⚠️ DeepLエラー: {response.status_code}")
-            return text # エラー時は原文を返す
+        response = _post_deepl(params)
     except Exception as e:
         print(f"  ⚠️ 通信エラー: {e}")
-        return text
-
-def translate_long_text(full_text):
-    """長文を段落ごとに翻訳して結合"""
-    paragraphs = full_text.split("\n\n")
-    translated_paragraphs = []
-    
-    print(f"  🤖 本文翻訳中: 全 {len(paragraphs)} 段落...")
+        return list(texts)
 
-    for i, para in enumerate(paragraphs):
-        if not para.strip(): continue
-        trans = translate_text_via_deepl(para)
-        translated_paragraphs.append(trans)
-        time.sleep(0.5) # レート制限対策
-        if (i + 1) % 10 == 0:
-            print(f"    ... {i + 1}/{len(paragraphs)} 完了")
-
-    return "\n\n".join(translated_paragraphs)
+    if response.status_code == 200:
+        # response.text経由のデコードを避け、バイト列をorjsonで直接パースする
+        try:
+            translations = [t["text"] for t in orjson.loads(response.content)["translations"]]
+        except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+            print(f"  ⚠️ DeepL応答の解析エラー: {e}")
+            return list(texts) # エラー時は原文を返す
+        if len(translations) != len(texts):
+            print(f"  ⚠️ DeepL応答の件数不一致: {len(translations)}/{len(texts)}")
+            return list(texts)
+        cache_put(texts, translations)
+        return translations
+    elif response.status_code == 429:
+        print("  ⚠️ DeepLエラー: リトライ上限に達しました")
+        return list(texts)
+    elif response.status_code == 456:
+        # 文字数の上限超過は待っても回復しないため、リトライしない
+        return [QUOTA_EXCEEDED_TEXT] * len(texts)
+    else:
+        print(f"  ⚠️ DeepLエラー: {response.status_code}")
+        return list(texts) # エラー時は原文を返す
+
+def iter_batches(paragraphs):
+    """段落を件数・バイト数の上限に収まるバッチに分割"""
+    batch = []
+    batch_bytes = 0
+    for para in paragraphs:
+        size = len(para.encode("utf-8"))
+        if batch and (len(batch) >= DEEPL_BATCH_SIZE or batch_bytes + size > DEEPL_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(para)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def needs_translation(para):
+    """URL・DOI・数式のような段落や、既に日本語の段落ならFalse (文字数の節約)"""
+    if _NO_TRANSLATE_RE.match(para):
+        return False
+    # かなを含まない段落 (中国語など) は日本語ではないので翻訳する
+    if not _KANA_RE.search(para):
+        return True
+    return len(_CJK_RE.findall(para)) <= len(para) * CJK_SKIP_RATIO
+
+def _progress_hash(text):
+    """原文段落の短いハッシュ (別のXMLから作られた途中経過を誤って使わないため)"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def load_progress(progress_path, paragraphs):
+    """前回中断時までに翻訳済みの段落を {段落番号: 翻訳文} で読み込む
+
+    原文のハッシュが一致しない記録は無視する。書き込み途中で中断された末尾の行は切り詰め、
+    以降の追記がその行に連結されないようにする
+    """
+    done = {}
+    if not progress_path or not os.path.exists(progress_path):
+        return done
+    with open(progress_path, "r+b") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            continue # 書き込み途中で中断された行
+        try:
+            entry = orjson.loads(line)
+            i = entry["i"]
+            if 0 <= i < len(paragraphs) and entry["h"] == _progress_hash(paragraphs[i]):
+                done[i] = entry["t"]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            continue
+    return done
+
+def append_progress(progress_path, indices, sources, translations):
+    """翻訳できた段落を1行1段落のJSONLで追記 (エラーで原文が返った段落は記録しない)"""
+    with open(progress_path, "ab") as f:
+        for i, src, trans in zip(indices, sources, translations):
+            if trans != src and trans != QUOTA_EXCEEDED_TEXT:
+                f.write(orjson.dumps({"i": i, "h": _progress_hash(src), "t": trans}) + b"\n")
+
+def translate_long_text(paragraphs, progress_path=None):
+    """本文の段落リストをバッチ翻訳し、同じ順序の翻訳文リストを返す (翻訳不要な段落は原文のまま)
+
+    progress_pathを指定すると翻訳済みの段落を逐次保存し、中断後はその続きから再開する
+    """
+    done = load_progress(progress_path, paragraphs)
+    targets = [i for i, p in enumerate(paragraphs) if i not in done and needs_translation(p)]
+
+    print(f"  🤖 本文翻訳中: 全 {len(paragraphs)} 段落 (翻訳不要: {len(paragraphs) - len(targets) - len(done)} 段落)...")
+    if done:
+        print(f"  ♻️ 前回の続きから再開: {len(done)} 段落は翻訳済み")
+
+    batches = list(iter_batches([paragraphs[i] for i in targets]))
+    results = [None] * len(batches) # 投入順に結果を格納して段落順を保つ
+    starts = [] # 各バッチの先頭段落がtargetsの何番目か
+    offset = 0
+    for batch in batches:
+        starts.append(offset)
+        offset += len(batch)
+    done_count = 0
+
+    with ThreadPoolExecutor(max_workers=DEEPL_CONCURRENCY) as ex:
+        futures = {ex.submit(translate_text_via_deepl, batch): i for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if progress_path:
+                batch_indices = targets[starts[i]:starts[i] + len(batches[i])]
+                append_progress(progress_path, batch_indices, batches[i], results[i])
+            done_count += len(batches[i])
+            print(f"    ... {done_count}/{len(targets)} 完了")
+
+    translated_paragraphs = list(paragraphs)
+    for i, trans in done.items():
+        translated_paragraphs[i] = trans
+    translated = (t for batch_result in results for t in batch_result)
+    for i, trans in zip(targets, translated):
+        translated_paragraphs[i] = trans
+    return translated_paragraphs
 
 # --- ▼ XML解析機能の強化 ▼ ---
 
+def format_reference(bib, i):
+    """biblStruct要素から参考文献1件分の文字列を作成"""
+    # 簡易的な抽出ロジック: タイトルと著者などを生のテキストとして結合
+    # 本来は細かくタグをパースすべきだが、GROBIDの出力構造に合わせて簡易化
+    ref_text_parts = []
+    
+    # タイトル (論文名 or 書籍名)
+    ref_title = next(bib.iter(TAG_TITLE), None)
+    if ref_title is not None and ref_title.text:
+        ref_text_parts.append(f"\"{ref_title.text}\"")
+    
+    # 発行年
+    date = next(bib.iter(TAG_DATE), None)
+    if date is not None and date.get('when'):
+        ref_text_parts.append(f"({date.get('when')})")
+    
+    # 雑誌名など
+    pubs = _XP_BIB_PUB(bib)
+    if pubs and pubs[0].text:
+        ref_text_parts.append(pubs[0].text)
+
+    # もし構造化データがうまく取れなければ、noteタグなどを探す（簡易対応）
+    full_ref_str = " ".join(ref_text_parts)
+    if not full_ref_str:
+        full_ref_str = "Extraction Failed"
+    
+    return f"[{i}] {full_ref_str}"
+
+def _handle_title(elem, data):
+    """1. タイトル抽出 (teiHeaderのtitleStmt直下の最初のtitleのみ)"""
+    if data["title"] is None and elem.getparent().tag == TAG_TITLE_STMT:
+        data["title"] = elem.text.strip() if elem.text else "No Title Found"
+    # 参考文献内のtitleはbiblStructの終了時に参照するため、ここでは解放しない
+    return False
+
+def _handle_p(elem, data):
+    """2. 本文抽出 (段落ごと)。teiHeader内(要旨など)の段落は対象外"""
+    if next(elem.iterancestors(TAG_TEXT), None) is None:
+        return False
+    # itertext()ですべてのタグ内のテキストを結合
+    text = "".join(elem.itertext()).strip()
+    if text:
+        data["body"].append(text)
+    return True
+
+def _handle_bib(elem, data):
+    """3. 参考文献抽出 (listBibl直下のbiblStructのみ)"""
+    if elem.getparent().tag != TAG_LIST_BIBL:
+        return False
+    data["references"].append(format_reference(elem, len(data["references"]) + 1))
+    return True
+
+# タグごとの処理。戻り値がTrueなら処理済みとして要素を解放する
+_TAG_HANDLERS = {
+    TAG_TITLE: _handle_title,
+    TAG_P: _handle_p,
+    TAG_BIB: _handle_bib,
+}
+
 def extract_data_from_xml(xml_content):
-    """XMLからタイトル、本文、参考文献を抽出する"""
+    """XMLからタイトル、本文、参考文献を抽出する (iterparseで逐次解析し、処理済み要素はすぐ解放)"""
     try:
-        root = ET.fromstring(xml_content)
-        
-        # 1. タイトル抽出
-        title_node = root.find('.//tei:teiHeader//tei:titleStmt/tei:title', NAMESPACES)
-        title = title_node.text.strip() if title_node is not None and title_node.text else "No Title Found"
-
-        # 2. 本文抽出 (段落ごと)
-        body_text_list = []
-        paragraphs = root.findall('.//tei:text//tei:p', NAMESPACES)
-        for p in paragraphs:
-            # itertext()ですべてのタグ内のテキストを結合
-            text = "".join(p.itertext()).strip()
-            if text:
-                body_text_list.append(text)
-        full_body = "\n\n".join(body_text_list)
-
-        # 3. 参考文献抽出
-        references = []
-        bib_structs = root.findall('.//tei:listBibl/tei:biblStruct', NAMESPACES)
-        
-        for i, bib in enumerate(bib_structs, 1):
-            # 簡易的な抽出ロジック: タイトルと著者などを生のテキストとして結合
-            # 本来は細かくタグをパースすべきだが、GROBIDの出力構造に合わせて簡易化
-            ref_text_parts = []
-            
-            # タイトル (論文名 or 書籍名)
-            ref_title = bib.find('.//tei:title', NAMESPACES)
-            if ref_title is not None and ref_title.text:
-                ref_text_parts.append(f"\"{ref_title.text}\"")
-            
-            # 発行年
-            date = bib.find('.//tei:date', NAMESPACES)
-            if date is not None and date.get('when'):
-                ref_text_parts.append(f"({date.get('when')})")
-            
-            # 雑誌名など
-            pub = bib.find('.//tei:publicationStmt/tei:publisher', NAMESPACES)
-            if pub is not None and pub.text:
-                ref_text_parts.append(pub.text)
-
-            # もし構造化データがうまく取れなければ、noteタグなどを探す（簡易対応）
-            full_ref_str = " ".join(ref_text_parts)
-            if not full_ref_str:
-                full_ref_str = "Extraction Failed"
-            
-            references.append(f"[{i}] {full_ref_str}")
+        data = {"title": None, "body": [], "references": []}
+
+        # huge_tree: 巨大なTEI出力でもlibxml2の上限で失敗しないようにする
+        context = etree.iterparse(
+            io.BytesIO(xml_content.encode("utf-8")),
+            events=("end",),
+            tag=tuple(_TAG_HANDLERS),
+            huge_tree=True
+        )
+        for _, elem in context:
+            if not _TAG_HANDLERS[elem.tag](elem, data):
+                continue
+
+            # 処理済みの要素と、その前にある兄弟要素を解放してメモリ使用量を抑える
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
         return {
-            "title": title,
-            "body": full_body,
-            "references": references
+            "title": data["title"] or "No Title Found",
+            "body": data["body"], # 段落のリスト
+            "references": data["references"]
         }
 
     except Exception as e:
@@ -136,9 +453,13 @@ def extract_data_from_xml(xml_content):
 
 # --- ▼ Word生成機能 ▼ ---
 
+# 既定テンプレートは起動時に1度だけ読み込み、PDFごとにメモリ上から複製する
+with open(os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx"), "rb") as _f:
+    _TEMPLATE_BYTES = _f.read()
+
 def create_word_document(data, output_path):
     """翻訳結果をWordファイルとして保存"""
-    doc = Document()
+    doc = Document(io.BytesIO(_TEMPLATE_BYTES))
 
     # 1. タイトル (日本語 + 英語)
     doc.add_heading(data['jp_title'], 0) # 大きな見出し
@@ -149,94 +470,186 @@ def create_word_document(data, output_path):
     doc.add_heading('本文 (Translated)', level=1)
     
     # 段落ごとにWordのパラグラフとして追加（読みやすさのため）
-    paragraphs = data['jp_body'].split("\n\n")
-    for p_text in paragraphs:
+    space_after = Pt(12) # 段落後の余白
+    for p_text in data['jp_body_paragraphs']:
         p = doc.add_paragraph(p_text)
-        p.paragraph_format.space_after = Pt(12) # 段落後の余白
+        p.paragraph_format.space_after = space_after
 
     # 3. 参考文献 (原文のまま)
     if data['references']:
         doc.add_page_break() # 改ページ
         doc.add_heading('参考文献 (References)', level=1)
+        list_style = doc.styles['List Number'] # スタイルの名前解決は1度だけ
         for ref in data['references']:
-            doc.add_paragraph(ref, style='List Number')
+            doc.add_paragraph(ref, style=list_style)
 
-    doc.save(output_path)
+    # 一時ファイルに保存してからリネーム (中断時に不完全なdocxを「完了済み」と誤認しないため)
+    tmp_path = output_path + ".tmp"
+    doc.save(tmp_path)
+    os.replace(tmp_path, output_path)
     print(f"  💾 Word保存完了: {os.path.basename(output_path)}")
 
 # --- ▼ メイン処理 ▼ ---
 
-def process_single_pdf(pdf_path):
+def get_output_paths(pdf_path):
     base_filename = os.path.basename(pdf_path).replace(".pdf", "")
     xml_path = os.path.join(OUTPUT_XML_DIR, f"{base_filename}.xml")
-    docx_path = os.path.join(OUTPUT_DOCX_DIR, f"{base_filename}_translated.docx")
-
-    # 翻訳済み(docxが存在する)ならスキップ
-    if os.path.exists(docx_path):
-        print(f"\n⏭️  完全スキップ (完了済み): {base_filename}")
-        return
+    docx_path = os.path.join(OUTPUT_DOCX_DIR, f"{base_filename}{DOCX_SUFFIX}")
+    return base_filename, xml_path, docx_path
+
+def post_pdf_to_grobid(pdf_path):
+    """PDFをGROBIDへストリーミング送信 (ファイル全体をメモリに読み込まない)"""
+    with open(pdf_path, 'rb') as f:
+        m = MultipartEncoder(fields={
+            'consolidateHeader': '1',
+            'consolidateCitations': '1',
+            'input': (os.path.basename(pdf_path), f, 'application/pdf')
+        })
+        return _SESSION.post(GROBID_URL, data=m, headers={'Content-Type': m.content_type}, timeout=GROBID_TIMEOUT)
+
+def _grobid_stage(pdf_path):
+    """GROBIDでPDFを解析し、XMLを返す (失敗・スキップ時はNone)"""
+    base_filename, xml_path, _ = get_output_paths(pdf_path)
 
     print(f"\n🔄 処理開始: {base_filename}")
 
-    # 1. GROBID実行 & XML保存
-    xml_content = ""
     if os.path.exists(xml_path):
-        print("  📂 既存のXMLを使用します。")
+        print(f"  📂 既存のXMLを使用します: {base_filename}")
         with open(xml_path, "r", encoding="utf-8") as f:
-            xml_content = f.read()
-    else:
+            return f.read()
+
+    for attempt in range(GROBID_MAX_RETRIES):
         try:
-            with open(pdf_path, 'rb') as f:
-                files = {'input': f}
-                resp = requests.post(GROBID_URL, files=files, data={'consolidateHeader': '1', 'consolidateCitations': '1'}, timeout=GROBID_TIMEOUT)
-            
-            if resp.status_code != 200:
-                print(f"  ❌ GROBIDエラー: {resp.status_code}")
-                return
-            
-            xml_content = resp.text
-            with open(xml_path, "w", encoding="utf-8") as f:
-                f.write(xml_content)
-            print("  ✅ PDF解析完了 (GROBID)")
+            resp = post_pdf_to_grobid(pdf_path)
         except Exception as e:
             print(f"  ❌ GROBID接続エラー: {e}")
-            return
-
-    # 2. XMLからデータ抽出
-    extracted_data = extract_data_from_xml(xml_content)
+            return None
+
+        if resp.status_code in (503, 408):
+            # GROBIDが混雑している場合は指数バックオフして再送 (最後の試行後は待たずに諦める)
+            if attempt == GROBID_MAX_RETRIES - 1:
+                break
+            wait = 2 ** attempt
+            print(f"  ⏳ GROBID混雑中 ({resp.status_code}): {wait}秒待機します...")
+            time.sleep(wait)
+            continue
+
+        if resp.status_code != 200:
+            print(f"  ❌ GROBIDエラー: {resp.status_code} ({base_filename})")
+            return None
+
+        xml_content = resp.text
+        write_text_atomic(xml_path, xml_content)
+        print(f"  ✅ PDF解析完了 (GROBID): {base_filename}")
+        return xml_content
+
+    print(f"  ❌ GROBIDエラー: リトライ上限に達しました ({base_filename})")
+    return None
+
+def _translate_stage(pdf_path, extracted_data):
+    """XMLから抽出したデータを翻訳し、Wordファイルとして保存
+
+    翻訳には時間がかかるため、XML文字列は渡さず抽出結果だけを受け取る
+    (呼び出し側で抽出後すぐにXMLへの参照を捨て、メモリを解放する)
+    """
+    base_filename, _, docx_path = get_output_paths(pdf_path)
+
+    # 1. 抽出結果の確認
     if not extracted_data or not extracted_data['body']:
-        print("  ⚠️ 本文抽出失敗")
+        print(f"  ⚠️ 本文抽出失敗: {base_filename}")
         return
 
-    # 3. 翻訳 (タイトルと本文)
+    # 2. 翻訳 (タイトルと本文)
     print(f"  🌍 タイトル翻訳中: {extracted_data['title'][:30]}...")
-    jp_title = translate_text_via_deepl(extracted_data['title'])
-    
-    jp_body = translate_long_text(extracted_data['body'])
+    jp_title = translate_text_via_deepl([extracted_data['title']])[0]
 
-    # 4. Word生成用データ作成
+    progress_path = os.path.join(OUTPUT_PROGRESS_DIR, f"{base_filename}.jsonl")
+    jp_body_paragraphs = translate_long_text(extracted_data['body'], progress_path)
+
+    # 3. Word生成用データ作成
     doc_data = {
         "en_title": extracted_data['title'],
         "jp_title": jp_title,
-        "jp_body": jp_body,
+        "jp_body_paragraphs": jp_body_paragraphs,
         "references": extracted_data['references'] # 参考文献は翻訳しない
     }
 
-    # 5. Word保存
+    # 4. Word保存 (保存できたら途中経過は不要)
     create_word_document(doc_data, docx_path)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+
+def _grobid_worker(pdf_path, grobid_queue):
+    """GROBID解析を行い、成功したXMLを翻訳キューへ渡す (生産者)"""
+    try:
+        xml_content = _grobid_stage(pdf_path)
+    except Exception as e:
+        print(f"  ❌ 処理エラー: {os.path.basename(pdf_path)}: {e}")
+        return
+    if xml_content:
+        grobid_queue.put((pdf_path, xml_content))
+
+def _translate_worker(grobid_queue):
+    """翻訳キューからXMLを取り出して翻訳する (消費者)。Noneを受け取ったら終了"""
+    while True:
+        item = grobid_queue.get()
+        if item is None:
+            break
+        pdf_path, xml_content = item
+        del item
+        try:
+            extracted_data = extract_data_from_xml(xml_content)
+            del xml_content # 翻訳中はXML文字列を保持しない
+            _translate_stage(pdf_path, extracted_data)
+        except Exception as e:
+            print(f"  ❌ 処理エラー: {os.path.basename(pdf_path)}: {e}")
 
 def main():
     setup_directories()
+    remove_orphan_tmp_files()
+    open_cache()
+    try:
+        run_pipeline()
+    finally:
+        close_cache()
+
+def list_completed_basenames():
+    """翻訳済み(docxが存在する)PDFのファイル名を、ディレクトリの一覧取得1回で集める"""
+    with os.scandir(OUTPUT_DOCX_DIR) as entries:
+        return {e.name[:-len(DOCX_SUFFIX)] for e in entries if e.name.endswith(DOCX_SUFFIX)}
+
+def run_pipeline():
     pdf_files = glob.glob(os.path.join(INPUT_DIR, "*.pdf"))
     
     if not pdf_files:
         print(f"'{INPUT_DIR}' にPDFがありません。")
         return
 
+    # 翻訳済み(docxが存在する)PDFはスキップ
+    completed = list_completed_basenames()
+    remaining = [p for p in pdf_files if get_output_paths(p)[0] not in completed]
+    if len(remaining) < len(pdf_files):
+        print(f"⏭️  完全スキップ (完了済み): {len(pdf_files) - len(remaining)} 件")
+    pdf_files = remaining
+    if not pdf_files:
+        print("\n--- 全てのPDFが翻訳済みです ---")
+        return
+
     print(f"--- {len(pdf_files)} 件のPDFをWord変換します ---")
-    
-    for pdf in pdf_files:
-        process_single_pdf(pdf)
+
+    # GROBID解析(生産者)とDeepL翻訳(消費者)をキューでつなぎ、両者を並行して進める
+    grobid_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    with ThreadPoolExecutor(max_workers=TRANSLATE_CONCURRENCY) as translate_ex:
+        for _ in range(TRANSLATE_CONCURRENCY):
+            translate_ex.submit(_translate_worker, grobid_queue)
+        try:
+            with ThreadPoolExecutor(max_workers=GROBID_CONCURRENCY) as grobid_ex:
+                for pdf in pdf_files:
+                    grobid_ex.submit(_grobid_worker, pdf, grobid_queue)
+        finally:
+            # 全てのGROBID解析が終わったら、翻訳ワーカーに終了を通知
+            for _ in range(TRANSLATE_CONCURRENCY):
+                grobid_queue.put(None)
 
     print("\n--- 全ての処理が完了しました ---")
 